@@ -28,6 +28,7 @@ __all__ = [
     "unifyUndo",
     "disableUndo",
     "disableViews",
+    "suspendRefresh",
     "disableAutoKey",
     "showWaitCursor",
     "restoreSelection",
@@ -164,3 +165,29 @@ def disableViews(fn):
     wrapped.__doc__ = fn.__doc__
 
     return wrapped
+
+
+_suspendRefreshDepth = 0
+
+
+def suspendRefresh(fn):
+
+    def wrapped(*args, **kwargs):
+        # Only the outermost call suspends and resumes the refresh,
+        # so nested decorated calls don't turn it back on too early
+        global _suspendRefreshDepth
+
+        if _suspendRefreshDepth == 0:
+            maya.cmds.refresh(suspend=True)
+        _suspendRefreshDepth += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _suspendRefreshDepth -= 1
+            if _suspendRefreshDepth == 0:
+                maya.cmds.refresh(suspend=False)
+
+    wrapped.__name__ = fn.__name__
+    wrapped.__doc__ = fn.__doc__
+
+    return wrapped
@@ -5,21 +5,23 @@ NOTE: Make sure you register this item in the config.
 import os
 import logging
 import json
-import re
-import glob
-from importlib import reload
 
-#* sunrise
-import sun_maya.anim_pre_fab.core.clusters as clustersFn
-import sun_maya.anim_pre_fab.core.rig as rigFn
+# Use orjson for the cluster manifest if it's available,
+# otherwise fall back to the built-in json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+# Stream the prefab entries with ijson if it's available,
+# otherwise read the whole manifest in one go
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 import studiolibrary
 
-from studiovendor.Qt import QtGui
-from studiovendor.Qt import QtCore
-from studiovendor.Qt import QtWidgets
-
 from studiolibrarymaya import baseitem, baseloadwidget, basesavewidget, mayafileitem, animitem, prefabitem
 
 try:
@@ -41,6 +43,9 @@ def save(path: str, root_node:str, *args, **kwargs):
         path (str): The path to save to
         root_node (str): The prefab rig to save
     """
+    #* sunrise - imported here to keep the Studio Library startup light
+    import sun_maya.anim_pre_fab.core.clusters as clustersFn
+
     if not cmds.objExists(root_node):
         logger.error("The given node '%s' does not exist!" % root_node)
         return
@@ -152,6 +157,10 @@ class PrefabClusterItem(mayafileitem.MayaFileItem):
     SAVE_WIDGET_CLASS = PrefabClusterSaveWidget
     IMPORT_NAMESPACE = "PREFAB_CLUSTER"
 
+    # Load the prefabs listed in cluster.json instead of importing the saved maya file.
+    # Disabled as the save method does not currently export the json manifest.
+    USE_JSON_MANIFEST = False
+
     def transferPath(self):
         return self.path() + "/mayafile.ma"
 
@@ -163,11 +172,53 @@ class PrefabClusterItem(mayafileitem.MayaFileItem):
     
    
     def _save_json(self, data):
-        with open(self.jsonPath(), "w") as fp:
-            json.dump(data, fp)
+        if orjson:
+            with open(self.jsonPath(), "wb") as fp:
+                fp.write(orjson.dumps(data))
+        else:
+            with open(self.jsonPath(), "w") as fp:
+                json.dump(data, fp)
         logger.info("Exported json data to %s", self.jsonPath())
 
+    def _load_json(self):
+        """
+        Reads the cluster manifest.
 
+        Returns:
+            tuple[str, Iterator[dict]]: The cluster name and its prefab entries
+        """
+        if ijson:
+            with open(self.jsonPath(), "rb") as fp:
+                name = next(ijson.items(fp, "name"), None)
+            prefabs = self._iter_json_prefabs()
+        else:
+            if orjson:
+                with open(self.jsonPath(), "rb") as fp:
+                    data = orjson.loads(fp.read())
+            else:
+                with open(self.jsonPath(), "r") as fp:
+                    data = json.load(fp)
+            name = data.get("name")
+            prefabs = iter(data.get("prefabs", []))
+
+        if name is None:
+            raise ValueError(f"The cluster manifest has no name: {self.jsonPath()}")
+        return name, prefabs
+
+    def _iter_json_prefabs(self):
+        """
+        Streams the prefab entries from the cluster manifest one at a time.
+
+        Yields:
+            dict: The prefab entry
+        """
+        with open(self.jsonPath(), "rb") as fp:
+            for prefab_data in ijson.items(fp, "prefabs.item"):
+                yield prefab_data
+
+
+    @mutils.unifyUndo
+    @mutils.suspendRefresh
     def save(self, **kwargs):
         """
         Exports the selected Prefab Cluster node.
@@ -176,54 +227,29 @@ class PrefabClusterItem(mayafileitem.MayaFileItem):
         Args:
             kwargs (dict)        
         """
-        sel = cmds.ls(sl=True, type="transform")
+        import sun_maya.anim_pre_fab.core.clusters as clustersFn
+
+        sel = cmds.ls(sl=True, type="transform", long=True) or []
         
-        #? Filter the selection list to contain nodes with the 'isPrefab' attribute
-        sel = [x for x in sel if cmds.attributeQuery("isPrefabCluster", node=x, exists=True)]
+        #? Filter the selection list to contain nodes with the 'isPrefabCluster' attribute
+        tagged = prefabitem.prefab_cluster_nodes()
+        sel = [x for x in sel if x in tagged]
         
         #? If nothing is selected, or if more than one object is selected, raise a ValueError
         if not sel or len(sel) > 1:
             raise ValueError("Please select a single PrefabCluster transform.")
 
-        cmds.select(sel[0], r=True)
-        cmds.parent(sel[0], world=True)
-        
-        #export_data = {"name" : sel[0], "prefabs" : []}
-        #cluster = clustersFn.PrefabCluster(sel[0])
-        
+        #? Unparent the cluster so it is exported on its own, keeping its world space transform
+        root_handle = prefabitem.get_node_handle(sel[0])
+        if cmds.listRelatives(sel[0], parent=True):
+            cmds.parent(sel[0], world=True)
+        cmds.select(prefabitem.get_node_from_handle(root_handle), r=True)
 
-        #* Export animItems for each prefab
-        '''
-        for prefab_dict in cluster.prefabs:
-            prefab_node = prefab_dict.get("name")
-            logger.debug("prefab_node: %s" % prefab_node)
-            prefab_name = prefab_dict.get("name").replace(":", "_")[0] # strip out the namespace
-            logger.debug("prefab_name: %s" % prefab_name)
-            source_path = prefab_dict.get("rig_path")
-            prefab = cluster.get_prefab_wrapper(prefab_node)
-            objects = prefab.controls
-            logger.debug("objects: %s" % objects)
-
-            anim_path = os.path.join(self.prefabAnimPath(), f"{prefab_name}.anim")
-            if not os.path.exists(anim_path):
-                os.makedirs(anim_path, exist_ok=True)
-            
-            animitem.save(anim_path, objects=objects)
-            
-            data = {
-                "name" : prefab_name, 
-                "source_path" : source_path, 
-                "anim_path" : anim_path
-            }
-            export_data["prefabs"].append(data)
-        '''
-            
         #? Save the maya file item
-        super(PrefabClusterItem, self).save(**kwargs)
-        cmds.parent(sel[0], clustersFn.ROOT_GROUP)
-
-        #//#? Save the JSON data
-        #//self._save_json(export_data)
+        try:
+            super(PrefabClusterItem, self).save(**kwargs)
+        finally:
+            cmds.parent(prefabitem.get_node_from_handle(root_handle), clustersFn.ROOT_GROUP)
 
     def load(self, **kwargs):
         """
@@ -232,9 +258,15 @@ class PrefabClusterItem(mayafileitem.MayaFileItem):
         Args:
             kwargs (dict)
         """
+        if self.USE_JSON_MANIFEST:
+            return self.load_from_json(**kwargs)
         return self._load_imported(**kwargs)
 
+    @mutils.unifyUndo
+    @mutils.suspendRefresh
     def _load_imported(self, **kwargs):
+        import sun_maya.anim_pre_fab.core.clusters as clustersFn
+
         logger.info("Loading %s %s", self.path(), kwargs)
 
         new_nodes = cmds.file(
@@ -247,57 +279,47 @@ class PrefabClusterItem(mayafileitem.MayaFileItem):
         )
 
         #? Get the imported root node
-        old_container = None
-        root_node = None
-        for x in new_nodes:
-            if cmds.nodeType(x) != "transform":
-                continue
-            
-            if cmds.attributeQuery("isPrefabCluster", node = x, exists = True):
-                root_node = x
-                break
+        root_node = prefabitem.find_tagged_root(new_nodes, "isPrefabCluster")
 
         if not root_node:
             raise ValueError(f"Could not find the prefab cluster's root node: {self.transferPath()}")
         logger.debug("root_node: %s" % root_node)
-        prefabs = [x for x in cmds.listRelatives(root_node, c=True) if rigFn.is_prefab(x)]
-        
-        
+
+        #? Get the next instance of the cluster from a single snapshot of the scene's namespaces
         duplicate_cluster = root_node.split(":")[-1]
-        new_namespace = f"{duplicate_cluster}_0"
-        duplicate_clusters = cmds.ls(f"*:{duplicate_cluster}")
-        if duplicate_cluster:
-            new_namespace = f"{duplicate_cluster}_{len(duplicate_cluster)}"
-            
-        
+        cmds.namespace(setNamespace=':')
+        namespaces = cmds.namespaceInfo(listOnlyNamespaces=True, recurse=True) or []
+        new_namespace = prefabitem.get_next_namespace(duplicate_cluster, namespaces)
+
+        root_handle = prefabitem.get_node_handle(root_node)
         cmds.parent(root_node, clustersFn.ROOT_GROUP)
         prefabitem.swap_namespace(self.IMPORT_NAMESPACE, new_namespace)
-        root_node = root_node.replace(self.IMPORT_NAMESPACE, new_namespace)
-        
-        
+        return prefabitem.get_node_from_handle(root_handle)
 
+    @mutils.unifyUndo
+    @mutils.suspendRefresh
     def load_from_json(self, **kwargs):
+        import sun_maya.anim_pre_fab.core.clusters as clustersFn
+
         #* Read JSON data
-        with open(self.jsonPath(), "r") as fp:
-            data = json.load(fp)
+        name, prefabs = self._load_json()
 
         #*  Create the cluster
-        cluster = clustersFn.PrefabCluster(data["name"])
+        cluster = clustersFn.PrefabCluster(name)
+
+        #* Query the existing namespaces once. The prefab loader adds each namespace it uses to the snapshot.
+        cmds.namespace(setNamespace=':')
+        namespaces = set(cmds.namespaceInfo(listOnlyNamespaces=True, recurse=True) or [])
 
         #* For each prefab, import it and parent it to this cluster
-        for prefab_data in data["prefabs"]:
+        for prefab_data in prefabs:
             src_path = prefab_data["source_path"]
             if not os.path.exists(src_path):
                 logger.error("Could not load prefab: %s" % src_path)
                 continue
             
-            all_prefabs = [x for x in cmds.ls(type="transform") if rigFn.is_prefab(x)]
-            
-            #* Load the prefab
-            prefabitem.load(src_path)
-            
-            #* Get the root imported node
-            prefab_node = [x for x in cmds.ls(type="transform") if rigFn.is_prefab(x) and x not in all_prefabs][0]
+            #* Load the prefab, and get the root imported node
+            prefab_node = prefabitem.load(src_path, namespaces=namespaces)
 
             #* Add prefab to cluster
             cluster.add_prefab(prefab_node)
@@ -305,7 +327,7 @@ class PrefabClusterItem(mayafileitem.MayaFileItem):
             
             anim_path = prefab_data["anim_path"]
             if not os.path.exists(anim_path):
-                LOGGER.warning("No animation found: %s" % anim_path)
+                logger.warning("No animation found: %s" % anim_path)
                 continue
             #* Load the animation
             animitem.load(anim_path, objects=prefab.controls)
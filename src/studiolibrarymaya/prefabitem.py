@@ -19,9 +19,9 @@ import logging
 from studiolibrarymaya import mayafileitem
 
 try:
-    #import mutils
-    import mutils.gui
+    import mutils
     import maya.cmds as cmds
+    import maya.api.OpenMaya as om
 except ImportError as error:
     print(error)
 
@@ -58,8 +58,8 @@ def save(path: str, root_node:str, *args, **kwargs):
     PrefabItem(path).save(*args, **kwargs)
 
 def load(path, *args, **kwargs):
-    """Convenience function for loading an PrefabItem."""
-    PrefabItem(path).load(*args, **kwargs)
+    """Convenience function for loading an PrefabItem. Returns the loaded root node."""
+    return PrefabItem(path).load(*args, **kwargs)
 
 def remove_namespace_from_node(node):
     """
@@ -72,11 +72,8 @@ def remove_namespace_from_node(node):
         str: The new node name
     """
     
-    try:
-        # Note rsplit instead of split
-        namespace, name = node.rsplit(":", 1)
-    except:
-        namespace, name = None, node
+    # Note rpartition instead of partition
+    namespace, _, name = node.rpartition(":")
 
     if namespace:
         try:
@@ -86,6 +83,89 @@ def remove_namespace_from_node(node):
             # E.g. namespaces embedded in references
             pass
 
+def prefab_nodes():
+    """
+    Returns all the Prefab nodes in the current scene, using a single
+    bulk query instead of querying each node.
+
+    Returns:
+        set[str]: The long names of all nodes with the 'isPrefab' attribute
+    """
+    return set(cmds.ls("*.isPrefab", objectsOnly=True, recursive=True, long=True) or [])
+
+def prefab_cluster_nodes():
+    """
+    Returns all the PrefabCluster nodes in the current scene, using a
+    single bulk query instead of querying each node.
+
+    Returns:
+        set[str]: The long names of all nodes with the 'isPrefabCluster' attribute
+    """
+    return set(cmds.ls("*.isPrefabCluster", objectsOnly=True, recursive=True, long=True) or [])
+
+def find_tagged_root(new_nodes, attr):
+    """
+    Returns the first transform in the given nodes that has the given
+    tag attribute (e.g. 'isPrefab' or 'isPrefabCluster').
+
+    Args:
+        new_nodes (list[str]): The nodes returned by cmds.file(returnNewNodes=True)
+        attr (str): The tag attribute to look for
+
+    Returns:
+        str or None: The long name of the tagged node, or None if not found
+    """
+    #? Check the type and attribute on the MObject through the API,
+    #? instead of going through the command engine for each node
+    sel = om.MSelectionList()
+    for node in new_nodes or []:
+        sel.clear()
+        try:
+            sel.add(node)
+        except RuntimeError:
+            #? Skip nodes that no longer exist, e.g. deleted during the import
+            continue
+
+        #? Only accept plain transforms, not subclasses such as joints or ik handles
+        obj = sel.getDependNode(0)
+        if obj.apiType() != om.MFn.kTransform:
+            continue
+
+        fn = om.MFnDagNode(obj)
+        if fn.hasAttribute(attr):
+            return fn.fullPathName()
+
+    return None
+
+def get_node_handle(node):
+    """
+    Returns a handle to the given node that stays valid when the
+    node is renamed, moved to another namespace or reparented.
+
+    Args:
+        node (str): The node to query
+
+    Returns:
+        om.MObjectHandle: The handle to the node
+    """
+    sel = om.MSelectionList()
+    sel.add(node)
+    return om.MObjectHandle(sel.getDependNode(0))
+
+def get_node_from_handle(handle):
+    """
+    Returns the current full path name of the node for the given handle.
+
+    Args:
+        handle (om.MObjectHandle): The handle returned by get_node_handle
+
+    Returns:
+        str: The full path name of the node
+    """
+    if not handle.isValid():
+        raise ValueError("The given node handle is no longer valid!")
+    return om.MFnDagNode(handle.object()).fullPathName()
+
 def swap_namespace(ns, target_ns):
     """
     Moves the contents of the given namespace to the target namespace.
@@ -152,14 +232,11 @@ def find_namespaces(search_ns):
     all_namespaces = list_all_namespaces()
     if not all_namespaces:
         logger.warning("No namespaces found in this scene!")
-        return
+        return []
     
-    #? Add any matching namespaces to an output list, and return it
-    output = list()
-    for ns in all_namespaces:
-        match = re.search(search_ns, ns)
-        if match:
-            output.append(match)
+    #? Return the namespaces that match the search pattern
+    pattern = re.compile(search_ns)
+    return [ns for ns in all_namespaces if pattern.search(ns)]
 
 def get_cache_from_root(root_node):
     """
@@ -182,6 +259,27 @@ def get_cache_from_root(root_node):
     #? Query the attribute to get the cache node and return it
     return cmds.listConnections(f"{root_node}.usd_cycle_cache")[0]
 
+def get_next_namespace(base_namespace, names, suffix=""):
+    """
+    Returns the base namespace with the instance number following the
+    highest one already used in the given names, padded to three digits.
+    E.g. 'prefab_003' if the names contain 'prefab_000' and 'prefab_002'.
+
+    Args:
+        base_namespace (str): The namespace without the instance number
+        names (Iterable[str]): The existing names to scan
+        suffix (str): Any text following the instance number in the names,
+            e.g. ':prefab' when scanning node names. Defaults to ""
+
+    Returns:
+        str: The next namespace
+    """
+    #? Match three or more digits, as the padding grows past 999 (e.g. 'prefab_1000')
+    pattern = re.compile(rf"^{re.escape(base_namespace)}_(\d{{3,}}){re.escape(suffix)}$")
+    matches = (pattern.match(name) for name in names)
+    used = [int(match.group(1)) for match in matches if match]
+    return f"{base_namespace}_{max(used, default=-1) + 1:03d}"
+
 def get_namespace_from_cache(cacheNode):
     """
     Returns the root_node name for the prefab rig from a given cacheNode
@@ -192,46 +290,39 @@ def get_namespace_from_cache(cacheNode):
     Returns:
         str: Root node name
     """
-    namespace, cacheNode = ":".join(cacheNode.split(":")[:-1]), cacheNode.split(":")[-1]
-    #? Ensure the cache name of the correct length
-    if len(cacheNode.split("_")) != 6:
-        raise ValueError("Invalid name - Could not extract: asset_code, asset_descriptor, asset_mod, cycle_name, cycle_descriptor, cache_version")
+    namespace, _, cacheNode = cacheNode.rpartition(":")
 
     #? EXAMPLE CACHE NODE NAME: c027_shepherd_m00_tall_dancing_03
     #? EXAMPLE CACHE NODE NAME: {asset_code}_{asset_descriptor}_{asset_mod}_{cycle_name}_{cycle_descriptor}_{cache_version}
-    asset_code, asset_descriptor, asset_mod, cycle_name, cycle_descriptor, cache_version = tuple(cacheNode.split("_"))
+    parts = cacheNode.split("_")
+
+    #? Ensure the cache name of the correct length
+    if len(parts) != 6:
+        raise ValueError("Invalid name - Could not extract: asset_code, asset_descriptor, asset_mod, cycle_name, cycle_descriptor, cache_version")
+
+    asset_code, asset_descriptor, asset_mod, cycle_name, cycle_descriptor, cache_version = parts
     
     #? Get the next instance
     #? ROOT NAME: {asset_code}_{asset_descriptor}_{asset_mod}_{cycle_descriptor}_{cycle_version} #_{instance}}
-    instance = 0
-    namespace = f"{asset_code}_{asset_descriptor}_{asset_mod}_{cycle_name}_{cycle_descriptor}"
+    base_namespace = f"{asset_code}_{asset_descriptor}_{asset_mod}_{cycle_name}_{cycle_descriptor}"
     rig_name = "prefab"
-    root_name = f"{namespace}:{rig_name}"
-
-    keepGoing = True
-    while keepGoing:
-        #? Join the root_name str and the current instance, padded to three digits
-        namespace = f"{asset_code}_{asset_descriptor}_{asset_mod}_{cycle_name}_{cycle_descriptor}"
-        namespace = "_".join([namespace, f"{instance:03d}"])
-        root_name = f"{namespace}:{rig_name}"
-
-        if cmds.objExists(root_name):
-            #? If the root_name exists, increment the instance and keep going
-            keepGoing = True
-            instance += 1
-        else:        
-            #? If the root_name does not exist, we found the next viable instance, so stop
-            keepGoing = False
-       
-    return namespace
 
-def get_namespace_from_root(root_node):
+    #? Snapshot the existing rig roots once, instead of querying Maya per instance
+    existing = cmds.ls(f"*:{rig_name}", long=False) or []
+
+    #? Join the namespace and the next instance, padded to three digits
+    return get_next_namespace(base_namespace, existing, suffix=f":{rig_name}")
+
+def get_namespace_from_root(root_node, namespaces=None):
     """
     Checks if the root node has a prefab_name attribute, and returns it.
     If no attribute, return None instead.
 
     Args:
         root_node (str): Root node to query
+        namespaces (set[str] or None): A snapshot of the scene's namespaces,
+            to avoid querying them again when loading many prefabs.
+            Defaults to None, which queries the scene.
 
     Returns:
         str or None: Given node's namespace
@@ -241,20 +332,14 @@ def get_namespace_from_root(root_node):
     
     base_namespace = cmds.getAttr(f"{root_node}.{PREFAB_NAME_ATTR}")
     
-    cmds.namespace(setNamespace=':')
-    all_namespaces = cmds.namespaceInfo(listOnlyNamespaces=True, recurse=True)
-
-    #? Get the instance number
-    instance = 0
-
-    while True:
-        namespace = f"{base_namespace}_{instance:03d}"
-        if namespace not in all_namespaces:
-            break
-        
-        instance += 1
+    if namespaces is None:
+        cmds.namespace(setNamespace=':')
+        existing = set(cmds.namespaceInfo(listOnlyNamespaces=True, recurse=True) or [])
+    else:
+        existing = namespaces
 
-    return namespace
+    #? Get the next instance number
+    return get_next_namespace(base_namespace, existing)
 
 def get_referenced_file_from_node(node):
     """
@@ -336,10 +421,11 @@ class PrefabItem(mayafileitem.MayaFileItem):
         """
         #? Make sure that a single prefab rig root node is selected
         #? Raise a value error if not.
-        sel = cmds.ls(sl=True, type="transform")
+        sel = cmds.ls(sl=True, type="transform", long=True) or []
         
         #? Filter the selection list to contain nodes with the 'isPrefab' attribute
-        sel = [x for x in sel if cmds.attributeQuery("isPrefab", node=x, exists=True)]
+        tagged = prefab_nodes()
+        sel = [x for x in sel if x in tagged]
         
         #? If nothing is selected, or if more than one object is selected, raise a ValueError
         if not sel or len(sel) > 1:
@@ -368,14 +454,21 @@ class PrefabItem(mayafileitem.MayaFileItem):
         #//return self._load_referenced(**kwargs)
         return self._load_imported(**kwargs)
 
-    def _load_imported(self, **kwargs):
+    @mutils.unifyUndo
+    @mutils.suspendRefresh
+    def _load_imported(self, namespaces=None, **kwargs):
         """
         This load method imports the given prefab rig instead of referencing it.
         This allows for compatibility between multiple maya versions, as 
         referencing multiple duplicate prefab rigs in Maya 2024 causes a crash.
 
         Args:
+            namespaces (set[str] or None): Optional snapshot of the scene's namespaces.
+                The namespace used for this prefab is added to it.
             kwargs (dict)
+
+        Returns:
+            str: The full path name of the loaded root node
         """
         logger.info("Loading %s %s", self.path(), kwargs)
 
@@ -389,14 +482,7 @@ class PrefabItem(mayafileitem.MayaFileItem):
         )
 
         #? Get the imported root node
-        root_node = None
-        for x in new_nodes:
-            if cmds.nodeType(x) != "transform":
-                continue
-
-            if cmds.attributeQuery("isPrefab", node = x, exists = True):
-                root_node = x
-                break
+        root_node = find_tagged_root(new_nodes, "isPrefab")
 
         if not root_node:
             raise ValueError(f"Could not find the prefab's root node: {self.transferPath}")
@@ -406,15 +492,20 @@ class PrefabItem(mayafileitem.MayaFileItem):
         cache_node = get_cache_from_root(root_node)
         
         #? Get the namespace from the cache node
-        new_namespace = get_namespace_from_root(root_node) or get_namespace_from_cache(cache_node)
+        new_namespace = get_namespace_from_root(root_node, namespaces) or get_namespace_from_cache(cache_node)
+        if namespaces is not None:
+            namespaces.add(new_namespace)
 
-        #? Swap to the new namespace
+        #? Swap to the new namespace, keeping track of the root node
+        root_handle = get_node_handle(root_node)
         swap_namespace(self.IMPORT_NAMESPACE, new_namespace)
-        root_node = root_node.replace(self.IMPORT_NAMESPACE, new_namespace)
+        root_node = get_node_from_handle(root_handle)
         
         #? Parent the root node to the prefabs group
         group_prefab(root_node)
 
+        return get_node_from_handle(root_handle)
+
     def _load_referenced(self, **kwargs):
         """
         This load method references the given prefab rig instead of importing it.
@@ -438,14 +529,7 @@ class PrefabItem(mayafileitem.MayaFileItem):
         )
         #//logger.debug(f"new_nodes: {new_nodes}")
         #? Get the imported root node
-        root_node = None
-        for x in new_nodes:
-            if cmds.nodeType(x) != "transform":
-                continue
-
-            if cmds.attributeQuery("isPrefab", node = x, exists = True):
-                root_node = x
-                break
+        root_node = find_tagged_root(new_nodes, "isPrefab")
 
         if not root_node:
             raise ValueError(f"Could not find the prefab's root node: {self.transferPath}")
@@ -459,9 +543,10 @@ class PrefabItem(mayafileitem.MayaFileItem):
         #? Get the reference path
         ref_path = get_referenced_file_from_node(root_node)
         
-        #? Move the nodes to it's new namespace
+        #? Move the nodes to it's new namespace, keeping track of the root node
+        root_handle = get_node_handle(root_node)
         swap_referenced_namespace(ref_path, new_namespace)
-        root_node = root_node.replace(self.IMPORT_NAMESPACE, new_namespace)
+        root_node = get_node_from_handle(root_handle)
                                       
         #? Parent the root node to the prefabs group
         group_prefab(root_node)
@@ -490,3 +575,35 @@ class PrefabItem(mayafileitem.MayaFileItem):
         except Exception as error:
             self.showErrorDialog("Item Error", str(error))
             raise
+
+
+def testGetNextNamespace():
+    """
+    Test the get_next_namespace function, including instance numbers past 999.
+
+    :rtype: None
+    """
+    tests = [
+        ([], "prefab_000"),
+        (["prefab_000", "prefab_002", "other_005"], "prefab_003"),
+        (["prefab_999"], "prefab_1000"),
+        (["prefab_999", "prefab_1000"], "prefab_1001"),
+    ]
+
+    for names, expected in tests:
+        result = get_next_namespace("prefab", names)
+        msg = "Data does not match {} {}".format(expected, result)
+        assert expected == result, msg
+
+    result = get_next_namespace("prefab", ["prefab_1000:prefab"], suffix=":prefab")
+    msg = "Data does not match {} {}".format("prefab_1001", result)
+    assert "prefab_1001" == result, msg
+
+
+def runTests():
+    """Run all the tests for this file."""
+    testGetNextNamespace()
+
+
+if __name__ == "__main__":
+    runTests()